@@ -1,89 +1,108 @@
 import streamlit as st
+import pandas as pd
 import random
 import json
 import requests
 import re
+import hashlib
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    json_loads = orjson.loads  # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
 # --- HELPER FUNCTIONS ---
 
-def generate_meals_with_gemini(dietary_prefs, dinner_settings, num_lunches):
+@st.cache_resource
+def get_http_session():
+    """
+    Returns a process-wide requests.Session so the TCP/TLS connection to the Gemini API
+    is kept alive and reused across reruns and regenerations. The pool is sized for the
+    concurrent per-pool requests, and connection errors and transient server errors are retried with backoff.
+    Read errors (including the read timeout) are never retried: the POST may already be generating, and
+    re-sending it would pay for another full generation.
+    """
+    session = requests.Session()
+    retries = Retry(total=2, read=False, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset({"POST"}))
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retries))
+    return session
+
+@st.cache_resource
+def get_executor():
+    """Process-wide thread pool that runs Gemini generations off the Streamlit script thread."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def submit_meal_generation(dietary_prefs, dinner_settings, num_lunches, use_cache=True, include_dinners=True):
     """
-    Calls the Gemini API to generate a consolidated prep plan and daily assembly instructions for lunches,
-    plus separate pools for different dinner styles if requested.
+    Starts generating a consolidated prep plan and daily assembly instructions for lunches,
+    plus separate pools for different dinner styles if requested, in a background thread.
+    Returns a Future (or None if the API key is missing) to be resolved with collect_meal_generation,
+    so the UI stays interactive while Gemini works.
+    Responses are cached per (normalized dietary_prefs, quick and full dinner pool sizes, num_lunches), so repeat generations are instant.
+    Pass use_cache=False to force a fresh response (e.g. when regenerating), and include_dinners=False
+    to request only the lunch plan, so regenerating lunches does not re-request (and pay for) the dinner pools.
     """
     try:
         api_key = st.secrets["GEMINI_API_KEY"]
     except KeyError:
         st.error("GEMINI_API_KEY not found. Please add it to your .streamlit/secrets.toml file.")
         return None
-        
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={api_key}"
-
-    # --- Dynamic JSON Schema and Prompt Construction ---
-    json_schema_properties = {
-        "LunchPrep": {
-            "type": "OBJECT",
-            "description": "A consolidated plan for prepping lunch components over the weekend.",
-            "properties": {
-                "ingredients": {"type": "ARRAY", "description": "A complete, aggregated list of all ingredients needed for all lunches.", "items": {"type": "OBJECT", "properties": {"item": {"type": "STRING"}, "quantity": {"type": "NUMBER"}, "unit": {"type": "STRING"}}, "required": ["item", "quantity", "unit"]}},
-                "prep_instructions": {"type": "STRING", "description": "A single, consolidated set of instructions for preparing all lunch components in one session."}
-            },
-            "required": ["ingredients", "prep_instructions"]
-        },
-        "LunchAssembly": {
-            "type": "ARRAY",
-            "description": f"A list of {num_lunches} unique lunch assembly plans for each day.",
-            "items": {
-                "type": "OBJECT",
-                "properties": {
-                    "name": {"type": "STRING", "description": "A creative name for the daily assembled lunch, e.g., 'Chicken & Quinoa Power Bowl'."},
-                    "assembly_instructions": {"type": "STRING", "description": "Simple, step-by-step instructions to combine prepped components."}
-                },
-                "required": ["name", "assembly_instructions"]
-            }
-        }
-    }
-    required_properties = ["LunchPrep", "LunchAssembly"]
-    dinner_prompt_parts = []
 
-    # Add dinner sections to schema if needed
-    if any(d['plan'] and d['style'] == "Quick Cook (<30 mins)" for d in dinner_settings.values()):
-        json_schema_properties["QuickDinner"] = {"type": "ARRAY", "description": "A list of 7 diverse, quick-cook dinner ideas.", "items": {"type": "OBJECT", "properties": {"name": {"type": "STRING"}, "ingredients": {"type": "ARRAY", "items": {"type": "OBJECT", "properties": {"item": {"type": "STRING"}, "quantity": {"type": "NUMBER"}, "unit": {"type": "STRING"}},"required": ["item", "quantity", "unit"]}}, "instructions": {"type": "STRING", "description": "Step-by-step cooking instructions."}}, "required": ["name", "ingredients", "instructions"]}}
-        required_properties.append("QuickDinner")
-        dinner_prompt_parts.append("a list of 7 quick-cook (under 30 minutes) dinner ideas")
+    # The normalized form is only the cache key; Gemini is sent the text exactly as entered
+    prefs_key = normalize_dietary_prefs(dietary_prefs)
 
-    if any(d['plan'] and d['style'] == "Full Cook (longer prep)" for d in dinner_settings.values()):
-        json_schema_properties["FullDinner"] = {"type": "ARRAY", "description": "A list of 7 diverse, 'full cook' dinner ideas.", "items": {"type": "OBJECT", "properties": {"name": {"type": "STRING"}, "ingredients": {"type": "ARRAY", "items": {"type": "OBJECT", "properties": {"item": {"type": "STRING"}, "quantity": {"type": "NUMBER"}, "unit": {"type": "STRING"}},"required": ["item", "quantity", "unit"]}}, "instructions": {"type": "STRING", "description": "Step-by-step cooking instructions."}}, "required": ["name", "ingredients", "instructions"]}}
-        required_properties.append("FullDinner")
-        dinner_prompt_parts.append("a list of 7 'full cook' (more involved) dinner ideas")
+    # Only how many dinners each pool needs affects the request, not which days use them
+    quick_days = full_days = 0
+    for d in dinner_settings.values():
+        if not d['plan']:
+            continue
+        if d['style'] == "Quick Cook (<30 mins)":
+            quick_days += 1
+        else:
+            full_days += 1
+    num_quick, num_full = dinner_pool_size(quick_days), dinner_pool_size(full_days)
+    if not include_dinners:
+        num_quick = num_full = 0
 
-    json_schema = {"type": "OBJECT", "properties": json_schema_properties, "required": list(set(required_properties))}
-    
-    dinner_prompt = f"Also, please generate { ' and '.join(dinner_prompt_parts) } for two people." if dinner_prompt_parts else ""
+    if not use_cache:
+        _call_gemini.clear(prefs_key, num_quick, num_full, num_lunches, dietary_prefs, api_key, None)
 
-    system_prompt = "You are an expert meal prep chef creating plans for a user in the UK. Your task is to create a smart, efficient weekly meal plan. All ingredient quantities **must** be in metric units (grams, kg, ml, L, etc.). For lunches, you must first design a set of common, preppable components, provide a single set of instructions to prepare them all at once, and then provide simple daily instructions to assemble them into unique meals. For dinners, provide full recipes. Adhere strictly to the user's dietary needs and return the response *only* in the requested JSON format."
-    user_prompt = (
-        f"Create a meal plan for one person based on these dietary requirements: '{dietary_prefs}'. "
-        f"IMPORTANT: All ingredient quantities must be in metric units (e.g., grams, ml).\n\n"
-        f"LUNCH PLAN (for {num_lunches} days):\n"
-        f"1.  First, create a consolidated 'LunchPrep' plan. This should include an aggregated list of all ingredients for the lunches, and one single set of cohesive instructions for prepping all components together during a weekend session (e.g., cook all grains, roast all vegetables, prepare all proteins).\n"
-        f"2.  Then, create {num_lunches} unique 'LunchAssembly' plans. Each should have a creative name and simple instructions for assembling the prepped components into a meal each day.\n\n"
-        f"DINNER PLAN:\n"
-        f"{dinner_prompt}"
-    )
+    # Resolved here on the script thread: st.cache_resource needs a ScriptRunContext, which executor threads lack
+    session = get_http_session()
+    return get_executor().submit(_call_gemini, prefs_key, num_quick, num_full, num_lunches, dietary_prefs, api_key, session, _refresh=not use_cache)
 
-    payload = {
-        "contents": [{"parts": [{"text": user_prompt}]}],
-        "systemInstruction": {"parts": [{"text": system_prompt}]},
-        "generationConfig": {"responseMimeType": "application/json", "responseSchema": json_schema}
-    }
+def dinner_pool_size(num_days):
+    """
+    Number of dinners to request for a pool used on num_days days (0 if unused): a couple more than
+    the days it fills, so regeneration has spares, and never fewer than 5 for variety.
+    """
+    return max(num_days + 2, 5) if num_days else 0
+
+def normalize_dietary_prefs(dietary_prefs):
+    """
+    Cache key for the preferences: lower-cased, deduped and sorted comma-separated tokens, so reordered or
+    re-cased input shares a cache entry. Only used for keying; it is never sent to the model.
+    """
+    return ", ".join(sorted({pref.strip().lower() for pref in dietary_prefs.split(',') if pref.strip()}))
 
+def collect_meal_generation(future):
+    """Returns the generated meals from a finished Future, reporting any failure in the UI."""
     try:
-        response = requests.post(api_url, json=payload)
-        response.raise_for_status()
-        response_json = response.json()
-        json_string = response_json['candidates'][0]['content']['parts'][0]['text']
-        return json.loads(json_string)
+        return future.result()
     except requests.exceptions.RequestException as e:
         st.error(f"API request failed: {e}")
         return None
@@ -91,6 +110,202 @@ def generate_meals_with_gemini(dietary_prefs, dinner_settings, num_lunches):
         st.error(f"Failed to parse API response: {e}")
         return None
 
+# Shared response-schema fragments, referenced (not copied) by every payload that needs them
+INGREDIENT_SCHEMA = {"type": "OBJECT", "properties": {"item": {"type": "STRING"}, "quantity": {"type": "NUMBER"}, "unit": {"type": "STRING"}}, "required": ["item", "quantity", "unit"]}
+DINNER_ITEM_SCHEMA = {"type": "OBJECT", "properties": {"name": {"type": "STRING"}, "ingredients": {"type": "ARRAY", "items": INGREDIENT_SCHEMA}, "instructions": {"type": "STRING", "description": "Step-by-step cooking instructions."}}, "required": ["name", "ingredients", "instructions"]}
+LUNCH_PREP_SCHEMA = {
+    "type": "OBJECT",
+    "description": "A consolidated plan for prepping lunch components over the weekend.",
+    "properties": {
+        "ingredients": {"type": "ARRAY", "description": "A complete, aggregated list of all ingredients needed for all lunches.", "items": INGREDIENT_SCHEMA},
+        "prep_instructions": {"type": "STRING", "description": "A single, consolidated set of instructions for preparing all lunch components in one session."}
+    },
+    "required": ["ingredients", "prep_instructions"]
+}
+LUNCH_ASSEMBLY_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "name": {"type": "STRING", "description": "A creative name for the daily assembled lunch, e.g., 'Chicken & Quinoa Power Bowl'."},
+            "assembly_instructions": {"type": "STRING", "description": "Simple, step-by-step instructions to combine prepped components."}
+        },
+        "required": ["name", "assembly_instructions"]
+    }
+}
+
+SYSTEM_PROMPT = "You are an expert meal prep chef creating plans for a user in the UK. Your task is to create a smart, efficient weekly meal plan. All ingredient quantities **must** be in metric units (grams, kg, ml, L, etc.). For lunches, you must first design a set of common, preppable components, provide a single set of instructions to prepare them all at once, and then provide simple daily instructions to assemble them into unique meals. For dinners, provide full recipes. Adhere strictly to the user's dietary needs and return the response *only* in the requested JSON format."
+SYSTEM_INSTRUCTION = {"parts": [{"text": SYSTEM_PROMPT}]}
+METRIC_UNITS_NOTE = "IMPORTANT: All ingredient quantities must be in metric units (e.g., grams, ml)."
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _call_gemini(prefs_key, num_quick, num_full, num_lunches, _dietary_prefs, _api_key, _session, _refresh=False):
+    """
+    Performs the Gemini requests. Pure apart from the network calls and the on-disk response cache
+    (see _post_gemini_cached), so that st.cache_data can memoize it;
+    errors are raised to the caller. Keyed on prefs_key (see normalize_dietary_prefs); the raw preference text,
+    the API key, the shared HTTP session and the _refresh flag (skip the disk cache) are excluded from the cache key.
+    Lunches and each dinner pool are requested as separate, smaller prompts issued concurrently,
+    so wall time is that of the slowest request rather than one large generation.
+    """
+    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={_api_key}"
+
+    payloads = [_lunch_payload(_dietary_prefs, num_lunches)]
+    if num_quick:
+        payloads.append(_quick_dinner_payload(_dietary_prefs, num_quick))
+    if num_full:
+        payloads.append(_full_dinner_payload(_dietary_prefs, num_full))
+
+    with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+        results = executor.map(lambda payload: _post_gemini_cached(_session, api_url, payload, _refresh), payloads)
+        meals = {}
+        for result in results:
+            meals.update(result)
+    _normalize_ingredients(meals)
+    _prerender_markdown(meals)
+    _index_dinner_pools(meals)
+    return meals
+
+def _normalize_ingredients(meals):
+    """
+    Attaches '_agg' = {(lower-cased item, unit): quantity} to the lunch prep and every dinner, with repeated
+    ingredients already summed, so the shopping-list aggregation never has to strip/lower ingredient names again.
+    """
+    recipes = [meals['LunchPrep']] if meals.get('LunchPrep') else []
+    recipes += meals.get('QuickDinner', []) + meals.get('FullDinner', [])
+    for recipe in recipes:
+        agg = defaultdict(float)
+        for ing in recipe.get('ingredients', []):
+            agg[(ing['item'].strip().lower(), ing['unit'])] += ing['quantity']
+        recipe['_agg'] = dict(agg)
+
+def _prerender_markdown(meals):
+    """
+    Renders the lunch prep, each lunch assembly and each dinner to a single '_md' Markdown string up front,
+    so displaying a meal is one st.markdown call and format_instructions never runs on a rerun.
+    """
+    if meals.get('LunchPrep'):
+        meals['LunchPrep']['_md'] = format_instructions(meals['LunchPrep'].get('prep_instructions'))
+    for lunch in meals.get('LunchAssembly', []):
+        lunch['_md'] = format_instructions(lunch.get('assembly_instructions'))
+    for dinner in meals.get('QuickDinner', []) + meals.get('FullDinner', []):
+        ingredients_md = "\n".join(f"- {ing['item']}: {ing['quantity']} {ing['unit']}" for ing in dinner.get('ingredients', []))
+        dinner['_md'] = f"**Ingredients:**\n{ingredients_md}\n\n**Instructions:**\n{format_instructions(dinner.get('instructions'))}"
+
+def _index_dinner_pools(meals):
+    """
+    Stores each dinner pool as {'names': [...], 'by_name': {name: meal}} so random picks work on a flat
+    list of names and resolve the chosen meal with a single dict lookup.
+    """
+    for meal_pool in ('QuickDinner', 'FullDinner'):
+        if meal_pool in meals:
+            by_name = {meal['name']: meal for meal in meals[meal_pool]}
+            meals[meal_pool] = {'names': list(by_name), 'by_name': by_name}
+
+# Second cache tier on disk, so responses survive server restarts and redeploys
+DISK_CACHE_DIR = Path(__file__).parent / ".gemini_cache"
+DISK_CACHE_TTL = 24 * 60 * 60  # seconds
+
+def _post_gemini_cached(session, api_url, payload, refresh=False):
+    """
+    Returns the response for a payload from the on-disk cache when a fresh entry exists, otherwise calls Gemini
+    and stores the result. The key is a hash of the whole payload (system prompt, user prompt and schema).
+    With refresh=True the cached entry is ignored and overwritten. Every write also prunes expired entries.
+    """
+    key = hashlib.blake2b(json.dumps(payload, sort_keys=True).encode(), digest_size=16).hexdigest()
+    path = DISK_CACHE_DIR / f"{key}.json"
+    if not refresh:
+        try:
+            if time.time() - path.stat().st_mtime < DISK_CACHE_TTL:
+                return json_loads(path.read_bytes())
+            path.unlink()  # expired; _prune_disk_cache clears out entries that are never requested again
+        except (OSError, ValueError):
+            pass  # missing or unreadable entry; fall through to the API
+
+    result = _post_gemini(session, api_url, payload)
+    tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+    try:
+        DISK_CACHE_DIR.mkdir(exist_ok=True)
+        tmp_path.write_text(json.dumps(result))
+        os.replace(tmp_path, path)  # atomic, so concurrent readers never see a partial file
+    except OSError:
+        tmp_path.unlink(missing_ok=True)  # caching is best-effort
+    _prune_disk_cache()
+    return result
+
+def _prune_disk_cache():
+    """
+    Deletes cache entries, and temp files left behind by failed writes, older than DISK_CACHE_TTL, so payloads
+    that are never requested again do not accumulate. Temp files of in-flight writes are far younger than that.
+    """
+    cutoff = time.time() - DISK_CACHE_TTL
+    for path in DISK_CACHE_DIR.glob("*.*"):
+        try:
+            if path.suffix in (".json", ".tmp") and path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass  # already removed by a concurrent prune
+
+# (connect, read): fail fast if the API is unreachable, but give generation a full minute
+GEMINI_TIMEOUT = (3.05, 60)
+
+def _post_gemini(session, api_url, payload):
+    """Sends a single generateContent request and returns the parsed JSON document from the response."""
+    response = session.post(api_url, data=json_dumps(payload), headers={"Content-Type": "application/json"}, timeout=GEMINI_TIMEOUT)
+    response.raise_for_status()
+    response_json = json_loads(response.content)
+    json_string = response_json['candidates'][0]['content']['parts'][0]['text']
+    return json_loads(json_string)
+
+def _build_payload(user_prompt, json_schema):
+    # Only the prompt and schema vary; the system instruction is shared by reference
+    return {
+        "contents": [{"parts": [{"text": user_prompt}]}],
+        "systemInstruction": SYSTEM_INSTRUCTION,
+        "generationConfig": {"responseMimeType": "application/json", "responseSchema": json_schema}
+    }
+
+@lru_cache(maxsize=8)
+def _lunch_schema(num_lunches):
+    """Response schema for the lunch request; only the LunchAssembly description depends on num_lunches."""
+    return {
+        "type": "OBJECT",
+        "properties": {
+            "LunchPrep": LUNCH_PREP_SCHEMA,
+            "LunchAssembly": {**LUNCH_ASSEMBLY_SCHEMA, "description": f"A list of {num_lunches} unique lunch assembly plans for each day."}
+        },
+        "required": ["LunchPrep", "LunchAssembly"]
+    }
+
+@lru_cache(maxsize=16)
+def _dinner_schema(meal_pool, description):
+    """Response schema for a single dinner pool (QuickDinner or FullDinner)."""
+    return {"type": "OBJECT", "properties": {meal_pool: {"type": "ARRAY", "description": description, "items": DINNER_ITEM_SCHEMA}}, "required": [meal_pool]}
+
+def _lunch_payload(dietary_prefs, num_lunches):
+    user_prompt = (
+        f"Create a lunch plan for one person based on these dietary requirements: '{dietary_prefs}'. "
+        f"{METRIC_UNITS_NOTE}\n\n"
+        f"LUNCH PLAN (for {num_lunches} days):\n"
+        f"1.  First, create a consolidated 'LunchPrep' plan. This should include an aggregated list of all ingredients for the lunches, and one single set of cohesive instructions for prepping all components together during a weekend session (e.g., cook all grains, roast all vegetables, prepare all proteins).\n"
+        f"2.  Then, create {num_lunches} unique 'LunchAssembly' plans. Each should have a creative name and simple instructions for assembling the prepped components into a meal each day."
+    )
+    return _build_payload(user_prompt, _lunch_schema(num_lunches))
+
+def _quick_dinner_payload(dietary_prefs, num_dinners):
+    user_prompt = (
+        f"Create a list of {num_dinners} quick-cook (under 30 minutes) dinner ideas for two people based on these dietary requirements: '{dietary_prefs}'. "
+        f"{METRIC_UNITS_NOTE}"
+    )
+    return _build_payload(user_prompt, _dinner_schema("QuickDinner", f"A list of {num_dinners} diverse, quick-cook dinner ideas."))
+
+def _full_dinner_payload(dietary_prefs, num_dinners):
+    user_prompt = (
+        f"Create a list of {num_dinners} 'full cook' (more involved) dinner ideas for two people based on these dietary requirements: '{dietary_prefs}'. "
+        f"{METRIC_UNITS_NOTE}"
+    )
+    return _build_payload(user_prompt, _dinner_schema("FullDinner", f"A list of {num_dinners} diverse, 'full cook' dinner ideas."))
+
 def format_instructions(instructions_text):
     """
     Formats a block of text into a clean, numbered markdown list.
@@ -115,64 +330,283 @@ def format_instructions(instructions_text):
     return "\n".join(formatted_steps)
 
 
-def get_random_meal(meal_type, existing_meals=None):
+def placeholder_meal(name):
+    """Stand-in meal for an empty or missing pool, with its '_md' rendered like a generated meal's."""
+    return {'name': name, 'ingredients': [], 'instructions': '', '_md': format_instructions('')}
+
+def get_random_meal(meal_type, existing_names=frozenset()):
+    """
+    Picks a random meal from the generated pool, avoiding any meal whose name is in existing_names
+    (a set, so each membership test is O(1)). Falls back to the whole pool if every meal is taken.
+    Tries a few random indices first (constant time when most of the pool is free), then falls back
+    to a single-pass reservoir sample, so no filtered copy of the pool is ever built.
+    """
     if 'generated_meals' not in st.session_state or not st.session_state.generated_meals:
-        return {'name': "Generate plan first!", 'ingredients': [], 'instructions': ''}
-    meal_list = st.session_state.generated_meals.get(meal_type, [])
-    if not meal_list:
-        return {'name': "No meals for this style.", 'ingredients': [], 'instructions': ''}
-    existing_names = [m['name'] for m in (existing_meals or [])]
-    eligible_meals = [m for m in meal_list if m['name'] not in existing_names]
-    return random.choice(eligible_meals) if eligible_meals else random.choice(meal_list)
-
-def generate_shopping_list(meal_plan, pantry_items):
-    required_items = {}
-    pantry_set = {item.strip().lower() for item in pantry_items}
-    
-    # Process lunch prep ingredients
-    if 'LunchPrep' in meal_plan and 'ingredients' in meal_plan['LunchPrep']:
-        for ingredient in meal_plan['LunchPrep']['ingredients']:
-            item_name = ingredient['item'].strip().lower()
-            if item_name in pantry_set: continue
-            key = (item_name, ingredient['unit'])
-            required_items[key] = required_items.get(key, 0) + ingredient['quantity']
-
-    # Process dinners
-    for meal in meal_plan.get('Dinners', {}).values():
-        if meal:
-            for ingredient in meal['ingredients']:
-                item_name = ingredient['item'].strip().lower()
-                if item_name in pantry_set: continue
-                key = (item_name, ingredient['unit'])
-                required_items[key] = required_items.get(key, 0) + ingredient['quantity']
-                
+        return placeholder_meal("Generate plan first!")
+    pool = st.session_state.generated_meals.get(meal_type)
+    if not pool or not pool['names']:
+        return placeholder_meal("No meals for this style.")
+    names = pool['names']
+    for _ in range(3):
+        name = names[random.randrange(len(names))]
+        if name not in existing_names:
+            return pool['by_name'][name]
+    pick, seen = None, 0
+    for name in names:
+        if name not in existing_names:
+            seen += 1
+            if random.randrange(seen) == 0:
+                pick = name
+    return pool['by_name'][pick if pick is not None else random.choice(names)]
+
+def assign_dinners(selected_days, dinner_settings, generated_meals):
+    """
+    Assigns a dinner to every planned day. Days are grouped by dinner style and each group draws
+    unique meals from its pool with a single random.sample, only repeating meals if the pool is too small.
+    """
+    days_by_pool = defaultdict(list)
+    for day in selected_days:
+        day_settings = dinner_settings.get(day, {'plan': False})
+        if day_settings['plan']:
+            meal_pool = "QuickDinner" if day_settings['style'] == "Quick Cook (<30 mins)" else "FullDinner"
+            days_by_pool[meal_pool].append(day)
+
+    dinners = {}
+    for meal_pool, days in days_by_pool.items():
+        pool = generated_meals.get(meal_pool)
+        if not pool or not pool['names']:
+            dinners.update((day, placeholder_meal("No meals for this style.")) for day in days)
+            continue
+        names = pool['names']
+        picks = random.sample(names, k=min(len(days), len(names)))
+        picks += random.choices(names, k=len(days) - len(picks))
+        dinners.update((day, pool['by_name'][name]) for day, name in zip(days, picks))
+    return {day: dinners[day] for day in selected_days if day in dinners}
+
+def update_ingredient_totals(totals, meal, sign=1):
+    """
+    Adds (sign=1) or removes (sign=-1) a meal's ingredients from the running (item, unit) -> quantity totals
+    (a defaultdict(float)), so swapping a single meal only touches that meal's ingredients instead of rebuilding the whole list.
+    """
+    if not meal:
+        return
+    for key, quantity in meal.get('_agg', {}).items():
+        totals[key] += sign * quantity
+        if abs(totals[key]) < 1e-9: del totals[key]
+
+def build_ingredient_totals(meal_plan):
+    """Computes the ingredient totals for a whole meal plan (lunch prep plus all dinners) from scratch."""
+    totals = defaultdict(float)
+    dinners = meal_plan.get('Dinners') or {}
+    meals = filter(None, chain((meal_plan.get('LunchPrep'),), dinners.values()))
+    for key, quantity in chain.from_iterable(meal.get('_agg', {}).items() for meal in meals):
+        totals[key] += quantity
+    return totals
+
+def normalize_pantry(pantry_items):
+    """Lower-cased, stripped pantry names as a frozenset for O(1) membership checks."""
+    return frozenset(item.strip().lower() for item in pantry_items)
+
+# Abbreviated/metric units read the same in the plural ("500 g", not "500 gs")
+UNINFLECTED_UNITS = frozenset({"g", "kg", "mg", "ml", "l", "cl", "dl", "tsp", "tbsp", "oz", "lb"})
+
+def format_quantity(quantity):
+    # Whole numbers print without a decimal point and large totals never switch to exponent notation
+    return f"{round(quantity, 6):f}".rstrip('0').rstrip('.')
+
+def pluralize_unit(unit, quantity):
+    # Handle pluralization robustly to avoid double 's' and pluralized abbreviations
+    if quantity > 1 and unit.lower() not in UNINFLECTED_UNITS and not unit.lower().endswith('s'):
+        return unit + 's'
+    return unit
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def generate_shopping_list(ingredient_items, pantry_set):
+    """
+    Formats the shopping list from a sorted tuple of ((item, unit), quantity) pairs, skipping pantry items.
+    Cached on its (hashable) inputs, so reruns with an unchanged plan and pantry reuse the same string;
+    bounded, since every dinner swap in every session produces a new key.
+    """
+    required_items = [(key, quantity) for key, quantity in ingredient_items if key[0] not in pantry_set]
+
     if not required_items: return "You have everything you need!"
-    shopping_list_str = ""
-    for (item, unit), quantity in sorted(required_items.items()):
-        # Handle pluralization more robustly to avoid double 's'
-        if quantity > 1 and not unit.lower().endswith('s'):
-            unit_str = unit + 's'
-        else:
-            unit_str = unit
-        shopping_list_str += f"- {item.title()}: {quantity} {unit_str}\n"
-    return shopping_list_str
+    return "".join(f"- {item.title()}: {format_quantity(quantity)} {pluralize_unit(unit, quantity)}\n" for (item, unit), quantity in required_items)
 
 # --- STREAMLIT APP ---
 
+DAYS_OF_WEEK = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+DEFAULT_DAYS = frozenset({"Monday", "Tuesday", "Wednesday", "Thursday", "Friday"})
+DINNER_STYLES = ("Quick Cook (<30 mins)", "Full Cook (longer prep)")
+# One row per day; rendered as a single st.data_editor instead of a set of widgets per day
+DEFAULT_DAY_TABLE = pd.DataFrame({
+    "Day": DAYS_OF_WEEK,
+    "Plan": [day in DEFAULT_DAYS for day in DAYS_OF_WEEK],
+    "Dinner": True,
+    "Dinner Style": DINNER_STYLES[0],
+})
+DEFAULT_PANTRY = ("Olive Oil", "Salt", "Black Pepper", "Garlic", "Onion Powder")
+
+# Streamlit drops any element that is not re-emitted on a rerun, so this is still written every run
+SIDEBAR_CSS = """
+<style>
+[data-testid="stSidebar"] { width: 400px !important; }
+</style>
+"""
+
+def init_session_state():
+    """Populates session state defaults once per session; later reruns skip straight past the guard."""
+    if st.session_state.get('_inited'):
+        return
+    st.session_state.update({
+        'meal_plan': {},
+        'pantry_items': list(DEFAULT_PANTRY),
+        'pantry_set': normalize_pantry(DEFAULT_PANTRY),
+        'show_shopping_list': False,
+        'ingredient_totals': defaultdict(float),
+        'generated_meals': None,
+        'dinner_settings': {},
+        'pending_generation': None,
+        '_inited': True,
+    })
+
+def start_generation(kind, dietary_prefs, selected_days, use_cache=True):
+    """Submits a background generation ('plan' or 'lunch') and remembers what to do with its result."""
+    future = submit_meal_generation(dietary_prefs, st.session_state.dinner_settings, len(selected_days), use_cache=use_cache, include_dinners=kind == 'plan')
+    if future:
+        st.session_state.pending_generation = {'kind': kind, 'future': future, 'selected_days': list(selected_days), 'dinner_settings': dict(st.session_state.dinner_settings)}
+
+def apply_finished_generation():
+    """Moves the result of a finished background generation into the meal plan."""
+    job = st.session_state.pending_generation
+    if not job or not job['future'].done():
+        return
+    st.session_state.pending_generation = None
+    new_meals = collect_meal_generation(job['future'])
+
+    if job['kind'] == 'plan':
+        if new_meals:
+            st.session_state.generated_meals = new_meals
+            st.session_state.meal_plan = {
+                'LunchPrep': new_meals.get('LunchPrep'),
+                'Lunches': new_meals.get('LunchAssembly', []),
+                'Dinners': assign_dinners(job['selected_days'], job['dinner_settings'], new_meals)
+            }
+            st.session_state.ingredient_totals = build_ingredient_totals(st.session_state.meal_plan)
+            st.toast("New meal plan generated!")
+        else:
+            st.error("Could not generate a meal plan. Please try again.")
+    else:
+        if new_meals:
+            st.session_state.generated_meals.update({'LunchPrep': new_meals.get('LunchPrep'), 'LunchAssembly': new_meals.get('LunchAssembly')})
+            update_ingredient_totals(st.session_state.ingredient_totals, st.session_state.meal_plan.get('LunchPrep'), sign=-1)
+            update_ingredient_totals(st.session_state.ingredient_totals, new_meals.get('LunchPrep'))
+            st.session_state.meal_plan.update({'LunchPrep': new_meals.get('LunchPrep'), 'Lunches': new_meals.get('LunchAssembly', [])})
+            st.toast("Lunch plan regenerated!")
+        else:
+            st.error("Failed to regenerate lunches.")
+
+@st.fragment(run_every=1)
+def generation_status():
+    """Polls the pending generation once a second and triggers a full rerun when it has finished."""
+    job = st.session_state.pending_generation
+    if not job:
+        return
+    if job['future'].done():
+        st.rerun()
+    if job['kind'] == 'plan':
+        st.info("🧠 Gemini is creating your smart meal prep plan...")
+    else:
+        st.info("🧠 Gemini is rethinking your lunch prep...")
+
+@st.fragment
+def render_lunch_prep(dietary_prefs, selected_days):
+    # --- LUNCH PREP SECTION ---
+    st.header("Weekend Lunch Prep 🧑‍🍳")
+    lunch_prep = st.session_state.meal_plan.get('LunchPrep')
+    if lunch_prep:
+        with st.container(border=True):
+            st.subheader("Consolidated Prep Instructions")
+            st.markdown(lunch_prep.get('_md', ""))
+            if st.button("Regenerate Entire Lunch Plan", disabled=st.session_state.pending_generation is not None):
+                start_generation('lunch', dietary_prefs, selected_days, use_cache=False)
+                st.rerun()
+
+def regenerate_dinner(day):
+    """Button callback: swaps one day's dinner for another from the same pool and updates the totals incrementally."""
+    dinner = st.session_state.meal_plan['Dinners'][day]
+    day_settings = st.session_state.dinner_settings.get(day)
+    meal_pool = "QuickDinner" if day_settings['style'] == "Quick Cook (<30 mins)" else "FullDinner"
+    # Avoid every dinner already on this week's plan, not just the one being replaced
+    planned_names = {meal['name'] for meal in st.session_state.meal_plan['Dinners'].values() if meal}
+    new_dinner = get_random_meal(meal_pool, planned_names)
+    st.session_state.meal_plan['Dinners'][day] = new_dinner
+    update_ingredient_totals(st.session_state.ingredient_totals, dinner, sign=-1)
+    update_ingredient_totals(st.session_state.ingredient_totals, new_dinner)
+    st.session_state.totals_changed = True
+
+def render_daily_meals(selected_days):
+    # --- DAILY ASSEMBLY & EVENING MEALS ---
+    st.header("Daily Meals 🍽️")
+    for i, day in enumerate(selected_days):
+        render_day_card(i, day)
+
+@st.fragment
+def render_day_card(i, day):
+    """
+    Renders one day's lunch and dinner. As a fragment, a 'Regenerate Dinner' click only reruns this day's card;
+    the whole app is rerun only when the visible shopping list has to reflect the new totals.
+    """
+    if st.session_state.pop('totals_changed', False) and st.session_state.show_shopping_list:
+        st.rerun()
+    lunches = st.session_state.meal_plan.get('Lunches', [])
+    lunch = lunches[i] if i < len(lunches) else None
+    dinner = st.session_state.meal_plan.get('Dinners', {}).get(day)
+
+    st.subheader(f"📅 {day}")
+
+    # Render Lunch section
+    st.markdown("#####  lunchtime 🥪 (Assembly)")
+    if lunch:
+        with st.expander(f"**{lunch['name']}**"):
+            st.markdown(lunch.get('_md', ""))
+
+    # Render Dinner section if it exists for the day
+    if dinner:
+        st.markdown("##### Evening Meal 🍝 (Cook Fresh)")
+        with st.expander(f"**{dinner['name']}**"):
+            st.markdown(dinner.get('_md', ""))
+            st.button("Regenerate Dinner", key=f"regen_dinner_{day}", on_click=regenerate_dinner, args=(day,))
+
+    st.divider()
+
+@st.fragment
+def render_pantry_and_shopping():
+    """Pantry editor and shopping list; as a fragment, updating the pantry does not re-render the meal plan."""
+    st.title("🛒 Shopping & Pantry")
+    pantry_col, shopping_col = st.columns(2)
+    with pantry_col:
+        st.subheader("Pantry Items")
+        pantry_text = st.text_area("Your Pantry:", value="\n".join(st.session_state.pantry_items), height=250, label_visibility="collapsed")
+        if st.button("Update Pantry List"):
+            st.session_state.pantry_items = [item.strip() for item in pantry_text.split('\n') if item.strip()]
+            st.session_state.pantry_set = normalize_pantry(st.session_state.pantry_items)
+            st.success("Pantry updated!")
+    with shopping_col:
+        st.subheader("Generated Shopping List")
+        if st.button("Generate Shopping List", type="primary"):
+            st.session_state.show_shopping_list = True
+        if st.session_state.show_shopping_list:
+            ingredient_items = tuple(sorted(st.session_state.ingredient_totals.items()))
+            shopping_list = generate_shopping_list(ingredient_items, st.session_state.pantry_set)
+            st.text_area("To Buy:", value=shopping_list, height=250, label_visibility="collapsed")
+        else:
+            st.info("Click 'Generate Shopping List' after finalizing your meal plan.")
+
 def main():
     st.set_page_config(page_title="Weekly Meal Planner", layout="wide")
-    
-    st.markdown(
-        """
-        <style>
-        [data-testid="stSidebar"] { width: 400px !important; }
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
-
-    for key, default in [('meal_plan', {}), ('pantry_items', ["Olive Oil", "Salt", "Black Pepper", "Garlic", "Onion Powder"]), ('shopping_list', ""), ('generated_meals', None), ('dinner_settings', {})]:
-        if key not in st.session_state: st.session_state[key] = default
+    st.markdown(SIDEBAR_CSS, unsafe_allow_html=True)
+    init_session_state()
+    apply_finished_generation()
 
     with st.sidebar:
         st.title("🍽️ Meal Plan Generator")
@@ -181,131 +615,44 @@ def main():
         dietary_prefs = st.text_input("Dietary Preferences & Allergens", "gluten-free, low-acid, no nuts, high-protein, meat-focused")
         
         st.header("Select Days to Plan")
-        days_of_week = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        default_days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
-        
-        selected_days_list = []
-        for day in days_of_week:
-            col1, col2 = st.columns([2, 3])
-            with col1: st.markdown(f"**{day}**")
-            with col2:
-                choice = st.radio(label=f"Plan for {day}?", options=["Plan", "Skip"], index=0 if day in default_days else 1, horizontal=True, key=f"radio_{day}", label_visibility="collapsed")
-            if choice == "Plan": selected_days_list.append(day)
-        selected_days = selected_days_list
-
-        if selected_days:
-            st.header("Evening Meal Settings")
-            for day in selected_days:
-                if day not in st.session_state.dinner_settings: st.session_state.dinner_settings[day] = {'plan': True, 'style': "Quick Cook (<30 mins)"}
-                with st.expander(day, expanded=False):
-                    st.session_state.dinner_settings[day]['plan'] = st.checkbox("Plan dinner?", value=st.session_state.dinner_settings[day]['plan'], key=f"plan_{day}")
-                    if st.session_state.dinner_settings[day]['plan']:
-                        st.session_state.dinner_settings[day]['style'] = st.radio("Style:", ["Quick Cook (<30 mins)", "Full Cook (longer prep)"], index=0 if st.session_state.dinner_settings[day]['style'] == "Quick Cook (<30 mins)" else 1, horizontal=True, key=f"style_{day}")
-        
-        if st.button("Generate Full Meal Plan", type="primary"):
+        day_table = st.data_editor(
+            DEFAULT_DAY_TABLE,
+            column_config={
+                "Day": st.column_config.TextColumn(disabled=True),
+                "Plan": st.column_config.CheckboxColumn("Plan?"),
+                "Dinner": st.column_config.CheckboxColumn("Dinner?"),
+                "Dinner Style": st.column_config.SelectboxColumn(options=DINNER_STYLES, required=True),
+            },
+            hide_index=True,
+            key="day_table",
+        )
+        planned = day_table[day_table["Plan"]]
+        selected_days = planned["Day"].tolist()
+        st.session_state.dinner_settings = {
+            day: {'plan': bool(plan_dinner), 'style': style}
+            for day, plan_dinner, style in zip(planned["Day"], planned["Dinner"], planned["Dinner Style"])
+        }
+
+        force_refresh = st.checkbox("Force refresh", help="Ignore cached Gemini responses and ask for a fresh plan.")
+        if st.button("Generate Full Meal Plan", type="primary", disabled=st.session_state.pending_generation is not None):
             if not selected_days:
                 st.warning("Please select at least one day to plan for.")
             else:
-                with st.spinner("🧠 Gemini is creating your smart meal prep plan..."):
-                    st.session_state.generated_meals = generate_meals_with_gemini(dietary_prefs, st.session_state.dinner_settings, len(selected_days))
-                
-                if st.session_state.generated_meals:
-                    st.session_state.meal_plan = {
-                        'LunchPrep': st.session_state.generated_meals.get('LunchPrep'),
-                        'Lunches': st.session_state.generated_meals.get('LunchAssembly', []),
-                        'Dinners': {}
-                    }
-                    for day in selected_days:
-                        day_settings = st.session_state.dinner_settings.get(day, {'plan': False})
-                        if day_settings['plan']:
-                            meal_pool = "QuickDinner" if day_settings['style'] == "Quick Cook (<30 mins)" else "FullDinner"
-                            st.session_state.meal_plan['Dinners'][day] = get_random_meal(meal_pool)
-                    st.session_state.shopping_list = ""
-                    st.success("New meal plan generated!")
-                else:
-                    st.error("Could not generate a meal plan. Please try again.")
+                start_generation('plan', dietary_prefs, selected_days, use_cache=not force_refresh)
 
     st.title("Your Weekly Meal Plan")
+    if st.session_state.pending_generation:
+        generation_status()
 
     if not st.session_state.meal_plan:
         st.info("Click 'Generate Full Meal Plan' in the sidebar to start.")
     else:
-        # --- LUNCH PREP SECTION ---
-        st.header("Weekend Lunch Prep 🧑‍🍳")
-        lunch_prep = st.session_state.meal_plan.get('LunchPrep')
-        if lunch_prep:
-            with st.container(border=True):
-                st.subheader("Consolidated Prep Instructions")
-                st.markdown(format_instructions(lunch_prep['prep_instructions']))
-                if st.button("Regenerate Entire Lunch Plan"):
-                    with st.spinner("🧠 Gemini is rethinking your lunch prep..."):
-                        new_meals = generate_meals_with_gemini(dietary_prefs, st.session_state.dinner_settings, len(selected_days))
-                        if new_meals:
-                            st.session_state.generated_meals.update({'LunchPrep': new_meals.get('LunchPrep'), 'LunchAssembly': new_meals.get('LunchAssembly')})
-                            st.session_state.meal_plan.update({'LunchPrep': new_meals.get('LunchPrep'), 'Lunches': new_meals.get('LunchAssembly', [])})
-                            st.session_state.shopping_list = ""
-                            st.success("Lunch plan regenerated!")
-                            st.rerun()
-                        else:
-                            st.error("Failed to regenerate lunches.")
-
+        render_lunch_prep(dietary_prefs, selected_days)
         st.divider()
-
-        # --- DAILY ASSEMBLY & EVENING MEALS ---
-        st.header("Daily Meals 🍽️")
-        lunches = st.session_state.meal_plan.get('Lunches', [])
-        dinners = st.session_state.meal_plan.get('Dinners', {})
-        
-        for i, day in enumerate(selected_days):
-            st.subheader(f"📅 {day}")
-            lunch = lunches[i] if i < len(lunches) else None
-            dinner = dinners.get(day)
-            
-            # Render Lunch section
-            st.markdown("#####  lunchtime 🥪 (Assembly)")
-            if lunch:
-                with st.expander(f"**{lunch['name']}**"):
-                    st.markdown(format_instructions(lunch['assembly_instructions']))
-
-            # Render Dinner section if it exists for the day
-            if dinner:
-                st.markdown("##### Evening Meal 🍝 (Cook Fresh)")
-                with st.expander(f"**{dinner['name']}**"):
-                    st.markdown("**Ingredients:**")
-                    ingredients_text = ""
-                    for ing in dinner['ingredients']:
-                        ingredients_text += f"- {ing['item']}: {ing['quantity']} {ing['unit']}\n"
-                    st.markdown(ingredients_text)
-                    
-                    st.markdown("**Instructions:**")
-                    st.markdown(format_instructions(dinner['instructions']))
-                    if st.button("Regenerate Dinner", key=f"regen_dinner_{day}"):
-                        day_settings = st.session_state.dinner_settings.get(day)
-                        meal_pool = "QuickDinner" if day_settings['style'] == "Quick Cook (<30 mins)" else "FullDinner"
-                        st.session_state.meal_plan['Dinners'][day] = get_random_meal(meal_pool, dinner)
-                        st.session_state.shopping_list = ""
-                        st.rerun()
-            
-            st.divider()
+        render_daily_meals(selected_days)
 
     if st.session_state.meal_plan:
-        st.title("🛒 Shopping & Pantry")
-        pantry_col, shopping_col = st.columns(2)
-        with pantry_col:
-            st.subheader("Pantry Items")
-            pantry_text = st.text_area("Your Pantry:", value="\n".join(st.session_state.pantry_items), height=250, label_visibility="collapsed")
-            if st.button("Update Pantry List"):
-                st.session_state.pantry_items = [item.strip() for item in pantry_text.split('\n') if item.strip()]
-                st.session_state.shopping_list = ""
-                st.success("Pantry updated!")
-        with shopping_col:
-            st.subheader("Generated Shopping List")
-            if st.button("Generate Shopping List", type="primary"):
-                st.session_state.shopping_list = generate_shopping_list(st.session_state.meal_plan, st.session_state.pantry_items)
-            if st.session_state.shopping_list:
-                st.text_area("To Buy:", value=st.session_state.shopping_list, height=250, label_visibility="collapsed")
-            else:
-                st.info("Click 'Generate Shopping List' after finalizing your meal plan.")
+        render_pantry_and_shopping()
 
 if __name__ == "__main__":
     main()